@@ -1,8 +1,12 @@
 import pytest
 import tiktoken
 import os
+import numpy as np
 
+import tiztoken.basic
+import tiztoken.regex
 from tiztoken import BasicTokenizer, RegexTokenizer, GPT4Tokenizer
+from tiztoken.base import get_stats, get_stats_np, merge, merge_batch
 
 # common test data
 
@@ -48,6 +52,20 @@ The ancestors of llamas are thought to have originated from the Great Plains of
 <|fim_prefix|>In Aymara mythology, llamas are important beings. The Heavenly Llama is said to drink water from the ocean and urinates as it rains.[6] According to Aymara eschatology,<|fim_suffix|> where they come from at the end of time.[6]<|fim_middle|> llamas will return to the water springs and ponds<|endofprompt|>
 """.strip()
 
+def reference_merges(text_chunks, num_merges):
+    # the straightforward training loop, recounting all the pairs
+    # and rebuilding all the lists of ids at every merge
+    ids = [list(chunk.encode("utf-8")) for chunk in text_chunks]
+    merges = {}
+    for i in range(num_merges):
+        stats = {}
+        for chunk_ids in ids:
+            get_stats(chunk_ids, stats)
+        pair = max(stats, key=stats.get)
+        ids = [merge(chunk_ids, pair, 256 + i) for chunk_ids in ids]
+        merges[pair] = 256 + i
+    return merges
+
 # tests
 
 # test encode/decode identity for a few different strings
@@ -61,6 +79,73 @@ def test_encode_decode_identity(tokenizer_factory, text):
     decoded = tokenizer.decode(ids)
     assert text == decoded
 
+# test that the vectorized pair counting matches get_stats
+@pytest.mark.parametrize("text", test_strings)
+def test_get_stats_np(text):
+    text_bytes = unpack(text).encode("utf-8")
+    assert get_stats_np(text_bytes) == get_stats(text_bytes)
+    assert get_stats_np([300 + b for b in text_bytes]) == get_stats([300 + b for b in text_bytes])
+    # a list of numpy integers is still a single list of ids
+    assert get_stats_np(list(np.frombuffer(text_bytes, dtype=np.uint8))) == get_stats(text_bytes)
+    # pairs never span two chunks
+    chunks = [text_bytes[:5], list(text_bytes[5:])]
+    assert get_stats_np(chunks) == get_stats(chunks[1], get_stats(chunks[0]))
+
+# test that merging a batch of pairs matches merging them one at a time
+def test_merge_batch():
+    ids = [1, 1, 1, 2, 3, 1, 1, 2, 3]
+    assert merge_batch(ids, {(1, 1): 4, (2, 3): 5}) == merge(merge(ids, (1, 1), 4), (2, 3), 5)
+    assert merge_batch(ids, {(1, 1): 4, (2, 3): 5}) == [4, 1, 5, 4, 5]
+
+# test that training learns the same merges, in the same order, as the reference loop
+# both with the pure Python training loop and, if numba is installed, the compiled one
+# (the 700 merges of llama_text run down to pairs seen once, with many ties per count)
+@pytest.mark.parametrize("compiled", [False, True])
+@pytest.mark.parametrize("text, num_merges", [("aaabdaaabac", 3), ("aaaaaaaaa", 3), (llama_text, 128), (llama_text, 700)])
+def test_basic_train_reference_merges(text, num_merges, compiled, monkeypatch):
+    if compiled and tiztoken.basic.train_basic is None:
+        pytest.skip("numba is not installed")
+    if compiled:
+        monkeypatch.setattr(tiztoken.basic, "TRAIN_NUMBA_MIN_BYTES", 0)
+    else:
+        monkeypatch.setattr(tiztoken.basic, "train_basic", None)
+    tokenizer = BasicTokenizer()
+    tokenizer.train(text, 256 + num_merges)
+    assert list(tokenizer.merges.items()) == list(reference_merges([text], num_merges).items())
+
+# test that long texts, encoded with numpy, get the same ids as with plain lists
+def test_basic_encode_np(monkeypatch):
+    tokenizer = BasicTokenizer()
+    tokenizer.train(llama_text, 256 + 128)
+    monkeypatch.setattr(tiztoken.basic, "ENCODE_NP_MIN_BYTES", 0)
+    ids = tokenizer.encode(llama_text)
+    monkeypatch.setattr(tiztoken.basic, "ENCODE_NP_MIN_BYTES", float("inf"))
+    assert ids == tokenizer.encode(llama_text)
+    assert tokenizer.decode(ids) == llama_text
+
+# test that RegexTokenizer training learns the same merges as the reference loop,
+# both in this process and split over worker processes
+@pytest.mark.parametrize("parallel", [False, True])
+@pytest.mark.parametrize("text, num_merges", [("aaabdaaabac", 1), (llama_text, 128)])
+def test_regex_train_reference_merges(text, num_merges, parallel, monkeypatch):
+    if parallel:
+        monkeypatch.setattr(tiztoken.regex, "PARALLEL_TRAIN_MIN_CHARS", 0)
+        monkeypatch.setattr(os, "cpu_count", lambda: 3)
+    tokenizer = RegexTokenizer()
+    tokenizer.train(text, 256 + num_merges)
+    text_chunks = tokenizer.compiled_pattern.findall(text)
+    assert list(tokenizer.merges.items()) == list(reference_merges(text_chunks, num_merges).items())
+
+# test that a text with no chunks at all fails the same way, with and without workers
+@pytest.mark.parametrize("parallel", [False, True])
+def test_regex_train_no_chunks(parallel, monkeypatch):
+    if parallel:
+        monkeypatch.setattr(tiztoken.regex, "PARALLEL_TRAIN_MIN_CHARS", 0)
+        monkeypatch.setattr(os, "cpu_count", lambda: 4)
+    tokenizer = RegexTokenizer(pattern="zzz")
+    with pytest.raises(ValueError, match="only has pairs for 0 merges"):
+        tokenizer.train("hello world", 258)
+
 # test that our tokenizer matches the official GPT4 tokenizer
 @pytest.mark.parametrize("text", test_strings)
 def test_gpt4_tiktoken_equality(text):
@@ -81,6 +166,27 @@ def test_gpt4_tiktoken_equality_special_tokens():
     gpt4_tokenizer_ids = tokenizer.encode(specials_string, allowed_special="all")
     assert gpt4_tokenizer_ids == tiktoken_ids
 
+# test that cached encodings cannot be modified by the caller and do not outlive the merges
+@pytest.mark.parametrize("tokenizer_factory", [BasicTokenizer, RegexTokenizer])
+def test_encode_cache(tokenizer_factory):
+    text = "The llama is a domesticated South American camelid"
+    tokenizer = tokenizer_factory()
+    tokenizer.train(llama_text, 256 + 64)
+    ids = tokenizer.encode(text)
+    ids.append(0)
+    assert tokenizer.encode(text) == ids[:-1]
+    if isinstance(tokenizer, RegexTokenizer):
+        # the chunks are cached on their own, and _encode_chunk is an override point
+        tokenizer._encode_chunk(b"llama").append(0)
+        assert 0 not in tokenizer.encode("llama")
+
+    # retrain with fewer merges, the text has to be encoded again
+    tokenizer.train(llama_text, 256 + 8)
+    retrained = tokenizer_factory()
+    retrained.train(llama_text, 256 + 8)
+    assert tokenizer.encode(text) == retrained.encode(text)
+    assert tokenizer.encode(text) != ids[:-1]
+
 @pytest.mark.parametrize("special_tokens", [{}, special_tokens])
 def test_save_load(special_tokens):
     # take a bit more complex piece of text and train the tokenizer, chosen at random
@@ -96,11 +202,14 @@ def test_save_load(special_tokens):
 
     # verify that save/load work as expected
     ids = tokenizer.encode(text, "all")
+    vocab = tokenizer.vocab
     # save the tokenizer
     tokenizer.save("test_tokenizer_tmp")
     # re-load the tokenizer
     tokenizer = RegexTokenizer()
     tokenizer.load("test_tokenizer_tmp.model")
+    # the vocab is rebuilt from the loaded merges
+    assert all(tokenizer.vocab[idx] == token for idx, token in vocab.items())
     # verify decode and encode
     assert tokenizer.decode(ids) == text
     assert tokenizer.decode(tokenizer.encode(text, "all")) == text
@@ -109,5 +218,38 @@ def test_save_load(special_tokens):
     for file in ["test_tokenizer_tmp.model", "test_tokenizer_tmp.vocab"]:
         os.remove(file)
 
+# test that models saved in the previous, text only, format can still be loaded
+def test_load_text_version():
+    tokenizer = RegexTokenizer()
+    tokenizer.train(llama_text, 256 + 64)
+    tokenizer.register_special_tokens(special_tokens)
+    ids = tokenizer.encode(llama_text, "all")
+
+    lines = ["tiztoken v1", tokenizer.pattern, str(len(special_tokens))]
+    lines += [f"{special_token} {idx}" for special_token, idx in special_tokens.items()]
+    lines += [f"{idx1} {idx2}" for idx1, idx2 in tokenizer.merges]
+    with open("test_tokenizer_tmp.model", "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+    loaded = RegexTokenizer()
+    loaded.load("test_tokenizer_tmp.model")
+    os.remove("test_tokenizer_tmp.model")
+    assert list(loaded.merges.items()) == list(tokenizer.merges.items())
+    assert loaded.special_tokens == special_tokens
+    assert loaded.decode(ids) == llama_text
+
+# test that a model file with half a merge at the end fails to load
+def test_load_truncated():
+    tokenizer = BasicTokenizer()
+    tokenizer.train(llama_text, 256 + 8)
+    tokenizer.save("test_tokenizer_tmp")
+    with open("test_tokenizer_tmp.model", "ab") as f:
+        f.write(np.array([97], dtype="<u4").tobytes())
+    loaded = BasicTokenizer()
+    with pytest.raises(AssertionError):
+        loaded.load("test_tokenizer_tmp.model")
+    for file in ["test_tokenizer_tmp.model", "test_tokenizer_tmp.vocab"]:
+        os.remove(file)
+
 if __name__ == "__main__":
     pytest.main()
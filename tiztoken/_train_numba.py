@@ -0,0 +1,163 @@
+"""
+The training loop of the BasicTokenizer compiled with numba.
+
+It is the same algorithm as learn_merges() in basic.py, on numpy arrays and
+numba typed containers instead of Python lists, dicts and sets. numba is an
+optional dependency, so importing this module fails if it is not installed.
+"""
+
+from heapq import heapify, heappop, heappush
+
+import numpy as np
+from numba import njit, types
+from numba.typed import Dict, List
+
+from .base import TOKENS
+
+# the pair statistics are keyed by the pairs packed into a single int64,
+# (p0 << 32) | p1, instead of by tuples
+pair_type = types.int64
+# list of the positions where a pair starts
+positions_type = types.ListType(types.int64)
+
+@njit(cache=True)
+def pack(p0, p1):
+    # the pair (p0, p1) as a single int64 key
+    return (np.int64(p0) << 32) | p1
+
+@njit(cache=True)
+def add_pair(pair_counts, pair_positions, pair, pos):
+    # record a new occurrence of pair starting at position pos
+    if pair in pair_counts:
+        pair_counts[pair] += 1
+        pair_positions[pair].append(pos)
+    else:
+        pair_counts[pair] = 1
+        positions = List.empty_list(types.int64)
+        positions.append(pos)
+        pair_positions[pair] = positions
+
+@njit(cache=True)
+def remove_pair(pair_counts, pair_positions, pair):
+    # forget an occurrence of pair, the position is left in the list of
+    # positions and skipped later on, since it no longer holds the pair
+    count = pair_counts[pair] - 1
+    if count:
+        pair_counts[pair] = count
+    else:
+        del pair_counts[pair]
+        del pair_positions[pair]
+
+@njit(cache=True)
+def holds_pair(ids, next_pos, pos, p0, p1):
+    # whether the pair (p0, p1) still starts at position pos
+    return ids[pos] == p0 and next_pos[pos] < len(ids) and ids[next_pos[pos]] == p1
+
+@njit(cache=True)
+def first_position(ids, next_pos, positions, pair):
+    # the first position where pair still starts, dropping along the way
+    # the positions where it no longer does, so that the list does not grow
+    p0, p1 = pair >> 32, pair & 0xffffffff
+    first = len(ids)
+    live = 0
+    for pos in positions:
+        if holds_pair(ids, next_pos, pos, p0, p1):
+            positions[live] = pos
+            live += 1
+            first = min(first, pos)
+    while len(positions) > live:
+        positions.pop()
+    return first
+
+@njit(cache=True)
+def train_basic(ids, num_merges):
+    """
+    Given the int32 array of the bytes of the text, learn up to num_merges
+    merges and return them as an array of rows (p0, p1, count), where the
+    row i is the pair merged into the token TOKENS + i
+    """
+    ids = ids.copy()
+    n = len(ids)
+    # doubly-linked list over the positions, see learn_merges() in basic.py
+    prev_pos = np.arange(-1, n - 1)
+    next_pos = np.arange(1, n + 1)
+
+    pair_counts = Dict.empty(key_type=pair_type, value_type=types.int64)
+    pair_positions = Dict.empty(key_type=pair_type, value_type=positions_type)
+    for pos in range(n - 1):
+        add_pair(pair_counts, pair_positions, pack(ids[pos], ids[pos + 1]), pos)
+
+    # the first position of every pair and the heap of (-count, first position, pair),
+    # with the old entries skipped when popped, see learn_merges() in basic.py
+    # (the positions were added in order, so the first one is the first position)
+    first_pos = Dict.empty(key_type=pair_type, value_type=types.int64)
+    heap = [(np.int64(0), np.int64(0), np.int64(0)) for _ in range(0)]
+    for p, c in pair_counts.items():
+        first_pos[p] = pair_positions[p][0]
+        heap.append((-c, first_pos[p], p))
+    heapify(heap)
+    # the pairs whose occurrences change during a merge, as a set
+    touched = Dict.empty(key_type=pair_type, value_type=types.boolean)
+
+    merges = np.empty((num_merges, 3), dtype=np.int64)
+    for i in range(num_merges):
+        # find the pair with the highest count, ties are broken by the
+        # first occurrence in ids
+        found = False
+        while len(heap):
+            neg_count, first, pair = heappop(heap)
+            if pair in pair_counts and pair_counts[pair] == -neg_count and first_pos[pair] == first:
+                found = True
+                break
+        if not found:
+            # nothing left to merge
+            return merges[:i]
+        count = -neg_count
+        # unpack the pair only now that it is chosen
+        p0, p1 = np.int32(pair >> 32), np.int32(pair & 0xffffffff)
+        idx = np.int32(TOKENS + i)
+
+        # replace all occurrences of pair in ids with idx, left to right
+        positions = np.sort(np.asarray(pair_positions.pop(pair)))
+        del pair_counts[pair]
+        del first_pos[pair]
+        touched.clear()
+        for pos in positions:
+            if not holds_pair(ids, next_pos, pos, p0, p1):
+                continue
+            right = next_pos[pos]
+            before = prev_pos[pos]
+            after = next_pos[right]
+
+            # the pairs around the occurrence now include idx
+            if before != -1:
+                remove_pair(pair_counts, pair_positions, pack(ids[before], p0))
+                add_pair(pair_counts, pair_positions, pack(ids[before], idx), before)
+                touched[pack(ids[before], p0)] = True
+                touched[pack(ids[before], idx)] = True
+            if after != n:
+                if pack(p1, ids[after]) != pair:
+                    remove_pair(pair_counts, pair_positions, pack(p1, ids[after]))
+                    touched[pack(p1, ids[after])] = True
+                add_pair(pair_counts, pair_positions, pack(idx, ids[after]), pos)
+                touched[pack(idx, ids[after])] = True
+                prev_pos[after] = pos
+
+            # unlink the right element of the pair
+            ids[pos] = idx
+            ids[right] = -1
+            next_pos[pos] = after
+
+        # push the new entries, the pairs that are gone are not pushed at all
+        for p in touched:
+            if p in pair_counts:
+                first = first_position(ids, next_pos, pair_positions[p], p)
+                first_pos[p] = first
+                heappush(heap, (-pair_counts[p], first, p))
+            elif p in first_pos:
+                del first_pos[p]
+
+        merges[i, 0] = p0
+        merges[i, 1] = p1
+        merges[i, 2] = count
+    return merges
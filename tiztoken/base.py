@@ -2,10 +2,28 @@
 Contains the base Tokenizer class and a few common helper functions.
 The base class also contains the (common) save/load functionality.
 """
+import sys
 import unicodedata
+from collections import Counter
+from itertools import chain, tee
+
+try:
+    from itertools import pairwise
+except ImportError:
+    # itertools.pairwise is only available from Python 3.10
+    def pairwise(iterable):
+        a, b = tee(iterable)
+        next(b, None)
+        return zip(a, b)
+
+import numpy as np
 
 # a few helper functions useful for BasicTokenizer and RegexTokenizer
 
+# the merge index of the pairs that cannot be merged, an int above any token id,
+# since comparing ints is cheaper than comparing them to float("inf")
+NO_MERGE = sys.maxsize
+
 def get_stats(ids, counts=None):
     """
     Given a list of integers, return a dictionary of counts of consecutive pairs
@@ -13,11 +31,85 @@ def get_stats(ids, counts=None):
     Optionally allows to update an existing dictionary of counts
     """
     counts = {} if counts is None else counts
-    # iterate consecutive elements
-    for pair in zip(ids, ids[1:]):
-        counts[pair] = counts.get(pair, 0) + 1
+    # bind the lookup once, instead of at every iteration
+    get = counts.get
+    # iterate consecutive elements, without copying ids into a slice
+    for pair in pairwise(ids):
+        counts[pair] = get(pair, 0) + 1
     return counts
 
+def get_stats_all(ids_list):
+    """
+    Given a list of lists of integers, return a Counter of the consecutive pairs
+    of all of them, pairs never span two lists. The counting is done at once by
+    the C implementation of Counter, instead of calling get_stats on each list
+    Example: [[1, 2, 3], [1, 2]] -> {(1, 2): 2, (2, 3): 1}
+    """
+    return Counter(chain.from_iterable(map(pairwise, ids_list)))
+
+def get_stats_np(ids):
+    """
+    Same as get_stats, but the pairs are counted by numpy in a single vectorized pass
+    ids can be bytes, a list of integers or a list of such chunks, in which case
+    the chunks are joined with a sentinel in between so no pair spans two chunks
+    Note: the pairs in the returned dictionary are sorted, not in order of appearance
+    Example: b"abab" -> {(97, 98): 2, (98, 97): 1}
+    """
+    def to_array(ids):
+        if isinstance(ids, (bytes, bytearray)):
+            return np.frombuffer(ids, dtype=np.uint8)
+        return np.asarray(ids, dtype=np.int64)
+
+    def is_chunk(ids):
+        # bytes or a sequence, as opposed to a single (Python or numpy) integer
+        return isinstance(ids, (bytes, bytearray)) or np.ndim(ids) > 0
+
+    if isinstance(ids, list) and ids and is_chunk(ids[0]):
+        # join the chunks, with a -1 after each of them
+        sentinel = np.array([-1], dtype=np.int64)
+        arr = np.concatenate([part for chunk_ids in ids for part in (to_array(chunk_ids), sentinel)])
+    else:
+        arr = to_array(ids)
+
+    if arr.dtype == np.uint8:
+        # raw bytes: every pair fits in 16 bits, so we can simply bincount them
+        shift = 8
+        counts = np.bincount((arr[:-1].astype(np.uint32) << shift) | arr[1:])
+        keys = np.flatnonzero(counts)
+        counts = counts[keys]
+    else:
+        # arbitrary ids: pack every pair into a 64 bits key, skipping the sentinels
+        shift = 32
+        keys = (arr[:-1] << shift) | arr[1:]
+        keys = keys[(arr[:-1] >= 0) & (arr[1:] >= 0)]
+        keys, counts = np.unique(keys, return_counts=True)
+
+    pairs = zip((keys >> shift).tolist(), (keys & ((1 << shift) - 1)).tolist())
+    return dict(zip(pairs, counts.tolist()))
+
+def find_best_merge(ids, merges):
+    """
+    Given a list of integers and the merges, return the consecutive pair with the
+    lowest merge index, or None if no pair can be merged, in a single pass
+    Example: ids=[1, 2, 3], merges={(2, 3): 256, (1, 2): 257} -> (2, 3)
+    """
+    return find_best_pair(pairwise(ids), merges)
+
+def find_best_pair(pairs, merges):
+    """
+    Same as find_best_merge, but given the pairs themselves, e.g. the keys of stats
+    Example: pairs=[(1, 2), (2, 3)], merges={(2, 3): 256, (1, 2): 257} -> (2, 3)
+    """
+    get = merges.get
+    best_pair = None
+    best_rank = NO_MERGE
+    for pair in pairs:
+        rank = get(pair, NO_MERGE)
+        if rank < best_rank:
+            best_pair = pair
+            best_rank = rank
+    return best_pair
+
 def merge(ids, pair, idx):
     """
     In the list of integers (ids), replace all consecutive occurrences
@@ -25,31 +117,102 @@ def merge(ids, pair, idx):
     Example: ids=[1, 2, 3, 1, 2], pair=(1, 2), idx=4 -> [4, 3, 4]
     """
     merged_ids = []
+    # bind everything the loop needs to locals, instead of looking it up
+    # at every iteration
+    append = merged_ids.append
+    p0, p1 = pair
+    n = len(ids)
+    last = n - 1
     i = 0
-    while i < len(ids):
+    while i < n:
         # if not at the very last position and the pair matches,
         # replace the pair with the new idx
-        if ids[i] == pair[0] and i < len(ids) - 1 and ids[i+1] == pair[1]:
-            merged_ids.append(idx)
+        if ids[i] == p0 and i < last and ids[i+1] == p1:
+            append(idx)
             i += 2
         else:
-            merged_ids.append(ids[i])
+            append(ids[i])
             i += 1
     return merged_ids
 
+def merge_batch(ids, batch_merges):
+    """
+    Same as merge, but replacing the occurrences of several pairs in a single pass,
+    batch_merges maps each pair to its idx and no two pairs can share a token,
+    so that the occurrences of different pairs never overlap
+    Example: ids=[1, 2, 3, 4, 1, 2], batch_merges={(1, 2): 5, (3, 4): 6} -> [5, 6, 5]
+    """
+    merged_ids = []
+    append = merged_ids.append
+    get = batch_merges.get
+    # most positions can be told apart by their first token alone
+    firsts = {p0 for p0, p1 in batch_merges}
+    n = len(ids)
+    last = n - 1
+    i = 0
+    while i < n:
+        # if not at the very last position and a pair of the batch matches,
+        # replace the pair with its idx
+        if ids[i] in firsts and i < last:
+            idx = get((ids[i], ids[i+1]))
+            if idx is not None:
+                append(idx)
+                i += 2
+                continue
+        append(ids[i])
+        i += 1
+    return merged_ids
+
+def merge_np(ids, pair, idx):
+    """
+    Same as merge, but on a numpy array of integers, vectorized
+    Example: ids=np.array([1, 1, 1, 2, 1, 1]), pair=(1, 1), idx=4 -> [4, 1, 2, 4]
+    """
+    p0, p1 = pair
+    # positions where the pair starts
+    starts = np.flatnonzero((ids[:-1] == p0) & (ids[1:] == p1))
+    if p0 == p1 and len(starts) > 1:
+        # the occurrences of a pair like (a, a) can overlap, as in aaa, and
+        # the left to right scan of merge only takes every other occurrence
+        # of a run of consecutive starts, so we do the same
+        run_starts = np.zeros(len(starts), dtype=np.int64)
+        new_runs = np.flatnonzero(np.diff(starts) != 1) + 1
+        run_starts[new_runs] = new_runs
+        run_starts = np.maximum.accumulate(run_starts)
+        starts = starts[(np.arange(len(starts)) - run_starts) % 2 == 0]
+    # write idx over the first element of each pair and drop the second one
+    merged_ids = ids.copy()
+    merged_ids[starts] = idx
+    keep = np.ones(len(ids), dtype=bool)
+    keep[starts + 1] = False
+    return merged_ids[keep]
+
+class ControlCharacterEscapes(dict):
+    """
+    Translation table for str.translate() that escapes the control characters
+    The table starts empty: the category of a code point is looked up the first
+    time it is translated, and cached, since precomputing it for all of unicode
+    would mean ~1M entries, most of them unassigned (and so control) code points
+    """
+
+    def __missing__(self, cp):
+        # http://www.unicode.org/reports/tr44/#GC_Values_Table
+        if unicodedata.category(chr(cp))[0] == "C":
+            # escape
+            translation = f"\\u{cp:04x}"
+        else:
+            # this character is ok
+            translation = cp
+        self[cp] = translation
+        return translation
+
+CONTROL_CHARACTER_ESCAPES = ControlCharacterEscapes()
+
 def replace_control_characters(s: str) -> str:
     # we don't want to print control characters because they distort the output (e.g. \n or much worse)
     # https://stackoverflow.com/questions/4324790/removing-control-characters-from-a-string-in-python/19016117#19016117
-    # http://www.unicode.org/reports/tr44/#GC_Values_Table
-    chars = []
-    for ch in s:
-        # this character is ok
-        if unicodedata.category(ch)[0] != "C":
-            chars.append(ch)
-        else:
-            # escape
-            chars.append(f"\\u{ord(ch):04x}")
-    return "".join(chars)
+    # translate() runs the loop over the characters in C
+    return s.translate(CONTROL_CHARACTER_ESCAPES)
 
 def render_token(t: bytes) -> str:
     # pretty print a token, escaping control characters
@@ -58,8 +221,14 @@ def render_token(t: bytes) -> str:
     return s
 
 # the base Tokenizer class
-VERSION = "tiztoken v1"
+VERSION = "tiztoken v2"
+# the previous version, with the merges saved as text, can still be loaded
+TEXT_VERSION = "tiztoken v1"
 TOKENS = 256
+# save() writes each file at once, through a large buffer
+WRITE_BUFFER_SIZE = 1 << 20
+# maximum number of encodings remembered by a Tokenizer
+ENCODE_CACHE_SIZE = 4096
 
 class Tokenizer:
     """Base class for Tokenizers"""
@@ -72,8 +241,23 @@ class Tokenizer:
         self.pattern = ""
         # str -> int, e.g. {'<|endoftext|>': 100257}
         self.special_tokens = {}
-        # int -> bytes
-        self.vocab = self._build_vocab()
+        # int -> bytes, built on first use, see the vocab property
+        self._vocab = None
+        # text -> ids, for the texts that were encoded recently
+        self._encode_cache = {}
+
+    @property
+    def vocab(self):
+        # the vocab is derived from the merges, and only decoding and saving
+        # need it, so it is built on first use: a tokenizer that is loaded
+        # just to encode text never pays for it
+        if self._vocab is None:
+            self._vocab = self._build_vocab()
+        return self._vocab
+
+    @vocab.setter
+    def vocab(self, vocab):
+        self._vocab = vocab
 
     def train(self, text, vocab_size, verbose=False):
         # Tokenizer can train a vocabulary of size vocab_size from text
@@ -87,6 +271,13 @@ class Tokenizer:
         # Tokenizer can decode a list of integers into a string
         raise NotImplementedError
 
+    def _cache_encoding(self, text, ids):
+        # remember the ids of text, forgetting the oldest encoding when full
+        cache = self._encode_cache
+        if len(cache) >= ENCODE_CACHE_SIZE:
+            del cache[next(iter(cache))]
+        cache[text] = ids
+
     def _build_vocab(self):
         # vocab is simply and deterministically derived from merges
         vocab = {idx: bytes([idx]) for idx in range(TOKENS)}
@@ -107,74 +298,87 @@ class Tokenizer:
         - vocab file is a pretty printed version for human inspection
         """
         # write the model to be used in load()
-        model_file = file_name + ".model"
-        with open(model_file, 'w') as f:
-            # write the version (compatibility) and pattern
-            f.write(f"{VERSION}\n")
-            f.write(f"{self.pattern}\n")
+        # the header is text, all its lines are joined in memory
+        # write the version (compatibility) and pattern
+        header_lines = [VERSION, self.pattern]
 
-            # write the special tokens, first the number of them, then each one
-            f.write(f"{len(self.special_tokens)}\n")
-            for special_token, idx in self.special_tokens.items():
-                f.write(f"{special_token} {idx}\n")
+        # write the special tokens, first the number of them, then each one
+        header_lines.append(f"{len(self.special_tokens)}")
+        header_lines.extend(f"{special_token} {idx}" for special_token, idx in self.special_tokens.items())
 
-            # write the merges dict
-            for idx1, idx2 in self.merges:
-                f.write(f"{idx1} {idx2}\n")
+        # write the merges dict, as the binary little-endian uint32 ids of
+        # the pairs, in order of merge index
+        merges = np.array(list(self.merges), dtype="<u4")
+
+        model_file = file_name + ".model"
+        with open(model_file, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(("\n".join(header_lines) + "\n").encode("utf-8"))
+            f.write(merges.tobytes())
 
         # write the vocab for the human inspection
-        vocab_file = file_name + ".vocab"
+        vocab = self.vocab
         inverted_merges = {idx: pair for pair, idx in self.merges.items()}
-        with open(vocab_file, "w", encoding="utf-8") as f:
-            for idx, token in self.vocab.items():
-                # note: many tokens may be partial utf-8 sequences
-                # and cannot be decoded into valid strings. So we're using
-                # errors='replace' to replace them with the replacement char �.
-                # this also means that we couldn't possibly use .vocab in load()
-                # because decoding in this way is a lossy operation
-                s = render_token(token)
-                # find the children of this token, if any
-                if idx in inverted_merges:
-                    # if this token has children, render it nicely as a merge
-                    idx0, idx1 = inverted_merges[idx]
-                    s0 = render_token(self.vocab[idx0])
-                    s1 = render_token(self.vocab[idx1])
-                    f.write(f"[{s0}][{s1}] -> [{s}] {idx}\n")
-                else:
-                    # otherwise this is leaf token, so just print it
-                    # this should correspond to the first 256 tokens, the bytes
-                    f.write(f"[{s}] {idx}\n")
+        vocab_lines = []
+        for idx, token in vocab.items():
+            # note: many tokens may be partial utf-8 sequences
+            # and cannot be decoded into valid strings. So we're using
+            # errors='replace' to replace them with the replacement char �.
+            # this also means that we couldn't possibly use .vocab in load()
+            # because decoding in this way is a lossy operation
+            s = render_token(token)
+            # find the children of this token, if any
+            if idx in inverted_merges:
+                # if this token has children, render it nicely as a merge
+                idx0, idx1 = inverted_merges[idx]
+                s0 = render_token(vocab[idx0])
+                s1 = render_token(vocab[idx1])
+                vocab_lines.append(f"[{s0}][{s1}] -> [{s}] {idx}")
+            else:
+                # otherwise this is leaf token, so just print it
+                # this should correspond to the first 256 tokens, the bytes
+                vocab_lines.append(f"[{s}] {idx}")
+
+        vocab_file = file_name + ".vocab"
+        with open(vocab_file, "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as f:
+            f.write("\n".join(vocab_lines) + "\n")
 
     def load(self, model_file):
         """Inverse of save() but only for the model file"""
         assert model_file.endswith(".model")
         # read the model file
-        merges = {}
         special_tokens = {}
-        idx = TOKENS
-        with open(model_file, 'r', encoding="utf-8") as f:
+        with open(model_file, 'rb') as f:
             # read the version
-            version = f.readline().strip()
-            assert version == VERSION
+            version = f.readline().decode("utf-8").strip()
+            assert version in (VERSION, TEXT_VERSION)
 
             # read the pattern
-            self.pattern = f.readline().strip()
+            self.pattern = f.readline().decode("utf-8").strip()
 
             # read the special tokens
             num_special_tokens = int(f.readline().strip())
 
             for _ in range(num_special_tokens):
-                special_token, special_token_idx = f.readline().strip().split()
+                special_token, special_token_idx = f.readline().decode("utf-8").strip().split()
                 special_tokens[special_token] = int(special_token_idx)
 
-            # read the merges
-            for line in f:
-                idx1, idx2 = map(int, line.split())
-                merges[(idx1, idx2)] = idx
-                idx += 1
+            # read the merges, all at once: the rest of the file is just
+            # the ids of the merged pairs, in order of merge index
+            if version == VERSION:
+                # binary little-endian uint32
+                ids = np.frombuffer(f.read(), dtype="<u4").tolist()
+            else:
+                # text, two ids per line
+                ids = list(map(int, f.read().split()))
+            # a truncated or corrupt file would otherwise lose its last id silently
+            assert len(ids) % 2 == 0
+            pairs = zip(ids[::2], ids[1::2])
+            merges = dict(zip(pairs, range(TOKENS, TOKENS + len(ids) // 2)))
 
-        # assign the loaded merges and special tokens
-        # and build the vocab from the them
+        # assign the loaded merges and special tokens,
+        # the vocab will be built from them on first use
         self.merges = merges
         self.special_tokens = special_tokens
-        self.vocab = self._build_vocab()
+        self.vocab = None
+        # the cached encodings were made with the old merges
+        self._encode_cache.clear()
@@ -6,7 +6,153 @@ But it does not handle the regular expression splitting pattern
 and does not handle any special tokens (added in the RegexTokenizer).
 """
 
-from .base import Tokenizer, TOKENS, get_stats, merge
+from array import array
+from heapq import heapify, heappop, heappush
+import numpy as np
+from .base import Tokenizer, TOKENS, find_best_merge, find_best_pair, get_stats_np, merge, merge_np
+
+try:
+    from ._train_numba import train_basic
+except ImportError:
+    # numba is optional, without it the training loop runs in pure Python
+    train_basic = None
+
+# texts of at least this many bytes are encoded with numpy, for shorter ones
+# the overhead of the arrays outweighs the vectorized counting and merging
+# e.g. with 500 merges, 4KB take about 70ms with numpy and 100ms with lists,
+# while below 2KB the lists are faster, and shorter texts are cached as well
+ENCODE_NP_MIN_BYTES = 1 << 12
+
+# texts of at least this many bytes are trained on with the numba training loop,
+# for shorter ones the pure Python loop is fast enough that compiling the numba
+# one on its first call (several seconds, if it is not cached yet) does not pay off
+# e.g. on 1MB of Python source, 8000 merges take 1.9s compiled and 5.5s in Python,
+# 16000 merges 1.8s and 6.1s, while compiling with no cache takes about 7.6s
+TRAIN_NUMBA_MIN_BYTES = 1 << 20
+
+# a few helpers to keep the pair statistics up to date during training
+
+def add_pair(pair_counts, pair_positions, pair, pos):
+    # record a new occurrence of pair starting at position pos
+    pair_counts[pair] = pair_counts.get(pair, 0) + 1
+    positions = pair_positions.get(pair)
+    if positions is None:
+        pair_positions[pair] = {pos}
+    else:
+        positions.add(pos)
+
+def remove_pair(pair_counts, pair_positions, pair, pos):
+    # forget the occurrence of pair starting at position pos
+    count = pair_counts[pair] - 1
+    if count:
+        pair_counts[pair] = count
+        pair_positions[pair].discard(pos)
+    else:
+        del pair_counts[pair]
+        del pair_positions[pair]
+
+def learn_merges(text_bytes, num_merges):
+    """
+    Given the bytes of the text, learn up to num_merges merges and yield them
+    as (pair, count), the i-th pair being the one merged into the token TOKENS + i
+    """
+    # to array of integers in range 0..255
+    # (from an iterator, since bytes would be read as the raw machine values)
+    ids = array("i", iter(text_bytes))
+
+    # instead of rebuilding ids at every merge, ids is kept as a doubly-linked
+    # list over the original positions: prev_pos[i] and next_pos[i] are the
+    # positions of the neighbours of i (-1 and n mark the two ends),
+    # and positions merged into their left neighbour get the id -1
+    # all three are arrays of machine integers rather than lists, which take
+    # a fraction of the memory of a list of Python ints on long texts
+    n = len(ids)
+    prev_pos = array("q", range(-1, n - 1))
+    next_pos = array("q", range(1, n + 1))
+
+    # count up the number of times every consecutive pair appears, once,
+    # and remember where it appears, so that a merge only has to update
+    # the pairs around the occurrences of the merged pair
+    # (int, int) -> int
+    pair_counts = get_stats_np(text_bytes)
+    # (int, int) -> set of the positions where the pair starts
+    # sorting the positions by pair groups them in the same (sorted) order
+    # of pair_counts, so the groups can be cut according to the counts
+    arr = np.frombuffer(text_bytes, dtype=np.uint8)
+    order = np.argsort((arr[:-1].astype(np.uint32) << 8) | arr[1:])
+    groups = np.split(order, np.cumsum(list(pair_counts.values()))[:-1])
+    pair_positions = {pair: set(positions.tolist()) for pair, positions in zip(pair_counts, groups)}
+
+    # (int, int) -> the first position where the pair starts
+    first_pos = {pair: min(positions) for pair, positions in pair_positions.items()}
+
+    # heap of (-count, first position, pair), so that finding the most common pair,
+    # ties broken by the first occurrence in ids, just like max() over get_stats(ids),
+    # does not scan all of pair_counts: whenever the count or the first position of
+    # a pair changes, the new entry is pushed and the old ones are left in the heap,
+    # to be skipped when popped since they no longer match pair_counts and first_pos
+    heap = [(-count, first_pos[pair], pair) for pair, count in pair_counts.items()]
+    heapify(heap)
+
+    # iteratively merge the most common pairs to create new tokens
+    for i in range(num_merges):
+        # find the pair with the highest count
+        while heap:
+            neg_count, first, pair = heappop(heap)
+            if pair_counts.get(pair) == -neg_count and first_pos[pair] == first:
+                break
+        else:
+            # nothing left to merge
+            return
+        count = -neg_count
+        p0, p1 = pair
+        # mint a new token: assign it the next available id
+        idx = TOKENS + i
+
+        # replace all occurrences of pair in ids with idx, left to right
+        # and keep track of the pairs whose occurrences change along the way
+        touched = set()
+        for pos in sorted(pair_positions.pop(pair)):
+            # the occurrence was consumed by the previous one,
+            # e.g. the second (a, a) in a run of three a
+            if ids[pos] != p0:
+                continue
+            right = next_pos[pos]
+            before = prev_pos[pos]
+            after = next_pos[right]
+
+            # the pairs around the occurrence now include idx
+            if before != -1:
+                remove_pair(pair_counts, pair_positions, (ids[before], p0), before)
+                add_pair(pair_counts, pair_positions, (ids[before], idx), before)
+                touched.add((ids[before], p0))
+                touched.add((ids[before], idx))
+            if after != n:
+                # (p1, ids[after]) can be pair itself, but then it is one
+                # of the occurrences that will be skipped as consumed
+                if (p1, ids[after]) != pair:
+                    remove_pair(pair_counts, pair_positions, (p1, ids[after]), right)
+                    touched.add((p1, ids[after]))
+                add_pair(pair_counts, pair_positions, (idx, ids[after]), pos)
+                touched.add((idx, ids[after]))
+                prev_pos[after] = pos
+
+            # unlink the right element of the pair
+            ids[pos] = idx
+            ids[right] = -1
+            next_pos[pos] = after
+        del pair_counts[pair]
+        del first_pos[pair]
+
+        # push the new entries, the pairs that are gone are not pushed at all
+        for p in touched:
+            c = pair_counts.get(p)
+            if c is None:
+                first_pos.pop(p, None)
+            else:
+                first = first_pos[p] = min(pair_positions[p])
+                heappush(heap, (-c, first, p))
+        yield pair, count
 
 class BasicTokenizer(Tokenizer):
 
@@ -20,61 +166,71 @@ class BasicTokenizer(Tokenizer):
         # input text preprocessing
         # from raw bytes
         text_bytes = text.encode("utf-8")
-        # to list of integers in range 0..255
-        ids = list(text_bytes)
+
+        # learn the merges, with the compiled training loop if numba is available
+        # and the text is long enough
+        if train_basic is not None and len(text_bytes) >= TRAIN_NUMBA_MIN_BYTES:
+            ids = np.frombuffer(text_bytes, dtype=np.uint8).astype(np.int32)
+            learned = (((p0, p1), count) for p0, p1, count in train_basic(ids, num_merges).tolist())
+        else:
+            learned = learn_merges(text_bytes, num_merges)
 
         # (int, int) -> int
         merges = {}
         # int -> bytes
         vocab = {idx: bytes([idx]) for idx in range(TOKENS)}
 
-        # iteratively merge the most common pairs to create new tokens
-        for i in range(num_merges):
-            # count up the number of times every consecutive pair appears
-            stats = get_stats(ids)
-            # find the pair with the highest count
-            pair = max(stats, key=stats.get)
-            # mint a new token: assign it the next available id
+        for i, (pair, count) in enumerate(learned):
+            # the new token was assigned the next available id
             idx = TOKENS + i
-            # replace all occurrences of pair in ids with idx
-            ids = merge(ids, pair, idx)
             # save the merge
             merges[pair] = idx
             vocab[idx] = vocab[pair[0]] + vocab[pair[1]]
 
             # prints if the verbose flag is set
             if verbose:
-                print(f"merge {i + 1}/{num_merges}: {pair} -> {idx} ({vocab[idx]}) had {stats[pair]} occurrences")
+                print(f"merge {i + 1}/{num_merges}: {pair} -> {idx} ({vocab[idx]}) had {count} occurrences")
+
+        if len(merges) < num_merges:
+            raise ValueError(f"the text only has pairs for {len(merges)} merges, not {num_merges}")
 
         # save class variables
         # used in encode()
         self.merges = merges
         # used in decode()
         self.vocab = vocab
+        # the cached encodings were made with the old merges
+        self._encode_cache.clear()
 
     def decode(self, ids):
         # given ids (list of integers), return a string
-        text_bytes = b"".join(self.vocab[idx] for idx in ids)
+        # every token is already in the vocab as bytes, so a single join
+        # copies each of them once into the output
+        text_bytes = b"".join(map(self.vocab.__getitem__, ids))
         text = text_bytes.decode("utf-8", errors="replace")
         return text
 
     def encode(self, text):
+        # encoding is deterministic, so a text that was already encoded is
+        # served from the cache, as a copy that the caller is free to modify
+        cached_ids = self._encode_cache.get(text)
+        if cached_ids is not None:
+            return list(cached_ids)
+
         # from raw bytes
         text_bytes = text.encode("utf-8")
+        if len(text_bytes) >= ENCODE_NP_MIN_BYTES:
+            # long texts are hardly ever repeated, and they would fill the
+            # cache with large entries, so they are not cached
+            return self._encode_np(text_bytes)
         # to list of integers in range 0..255
         ids = list(text_bytes)
 
         # given a string text, return the token ids
         while len(ids) >= 2:
             # find the pair with the lowest merge index
-            stats = get_stats(ids)
-            pair = min(stats, key=lambda p: self.merges.get(p, float("inf")))
-
-            # subtle: if there are no more merges available, the key will
-            # result in an inf for every single pair, and the min will be
-            # just the first pair in the list, arbitrarily
-            # we can detect this terminating case by a membership check
-            if pair not in self.merges:
+            pair = find_best_merge(ids, self.merges)
+            if pair is None:
                 # nothing can be merged anymore
                 break
 
@@ -82,4 +238,19 @@ class BasicTokenizer(Tokenizer):
             idx = self.merges[pair]
             ids = merge(ids, pair, idx)
 
+        self._cache_encoding(text, tuple(ids))
         return ids
+
+    def _encode_np(self, text_bytes):
+        # same as encode, but counting and merging the pairs with numpy
+        ids = np.frombuffer(text_bytes, dtype=np.uint8).astype(np.int64)
+        while len(ids) >= 2:
+            # find the pair with the lowest merge index
+            stats = get_stats_np(ids)
+            pair = find_best_pair(stats, self.merges)
+            if pair is None:
+                # nothing can be merged anymore
+                break
+            idx = self.merges[pair]
+            ids = merge_np(ids, pair, idx)
+        return ids.tolist()
@@ -86,7 +86,7 @@ class GPT4Tokenizer(RegexTokenizer):
 
     def decode(self, ids):
         # we have to un-permute the bytes before we decode
-        text_bytes = b"".join(self.vocab[idx] for idx in ids)
+        text_bytes = b"".join(map(self.vocab.__getitem__, ids))
         text_bytes = bytes(self.inverse_byte_shuffle[b] for b in text_bytes)
         text = text_bytes.decode("utf-8", errors="replace")
         return text
@@ -106,7 +106,7 @@ class GPT4Tokenizer(RegexTokenizer):
         # for visualization purposes we can output the GPT-4 tokens
         # in the exact same format as the base class woulds
         # python -c "from tiztoken import GPT4Tokenizer; GPT4Tokenizer().save_vocab('gpt4.vocab')"
-        from .base import render_token
+        from .base import render_token, WRITE_BUFFER_SIZE
 
         # build vocab being mindful of the byte shuffle
         vocab = {idx: bytes([self.inverse_byte_shuffle[idx]]) for idx in range(256)}
@@ -115,13 +115,15 @@ class GPT4Tokenizer(RegexTokenizer):
 
         # now merge the shuffled bytes and write to file
         inverted_merges = {idx: pair for pair, idx in self.merges.items()}
-        with open(vocab_file, "w", encoding="utf-8") as f:
-            for idx, token in vocab.items():
-                s = render_token(token)
-                if idx in inverted_merges:
-                    idx0, idx1 = inverted_merges[idx]
-                    s0 = render_token(vocab[idx0])
-                    s1 = render_token(vocab[idx1])
-                    f.write(f"[{s0}][{s1}] -> [{s}] {idx}\n")
-                else:
-                    f.write(f"[{s}] {idx}\n")
+        vocab_lines = []
+        for idx, token in vocab.items():
+            s = render_token(token)
+            if idx in inverted_merges:
+                idx0, idx1 = inverted_merges[idx]
+                s0 = render_token(vocab[idx0])
+                s1 = render_token(vocab[idx1])
+                vocab_lines.append(f"[{s0}][{s1}] -> [{s}] {idx}")
+            else:
+                vocab_lines.append(f"[{s}] {idx}")
+        with open(vocab_file, "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as f:
+            f.write("\n".join(vocab_lines) + "\n")
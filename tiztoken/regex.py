@@ -6,14 +6,83 @@ Unlike BasicTokenizer, RegexTokenizer handles an optional regex
 splitting pattern and optional special tokens.
 """
 
+import os
+from collections import Counter
+from itertools import islice
+from multiprocessing import Pipe, Process
 import regex as re
-from .base import Tokenizer, get_stats, merge
+from .base import Tokenizer, find_best_merge, get_stats_all, merge, merge_batch
 
 # the main GPT text split patterns, as at the time of writing:
 # https://github.com/openai/tiktoken/blob/main/tiktoken_ext/openai_public.py
 GPT2_SPLIT_PATTERN = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
 GPT4_SPLIT_PATTERN = r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]++[\r\n]*|\s*[\r\n]|\s+(?!\S)|\s+"""
 
+# texts of at least this many characters are trained on by one worker process
+# per CPU, each one counting and merging the pairs of its share of the chunks
+PARALLEL_TRAIN_MIN_CHARS = 1 << 24
+
+def train_worker(conn, ids):
+    """
+    Worker process of RegexTokenizer.train: holds a contiguous share of the
+    chunks, sends back their stats and waits for the merges to apply to them
+    """
+    while True:
+        conn.send(get_stats_all(ids))
+        batch_merges = conn.recv()
+        ids = [merge_batch(chunk_ids, batch_merges) for chunk_ids in ids]
+
+def start_train_workers(ids, num_workers):
+    # split the chunks in contiguous shares, one per worker
+    size = -(-len(ids) // num_workers)
+    workers = []
+    for start in range(0, len(ids), size):
+        conn, worker_conn = Pipe()
+        process = Process(target=train_worker, args=(worker_conn, ids[start:start + size]), daemon=True)
+        process.start()
+        worker_conn.close()
+        workers.append((process, conn))
+    return workers
+
+def stop_train_workers(workers):
+    # the workers are left waiting for a merge, so they are just terminated
+    for process, conn in workers:
+        process.terminate()
+        process.join()
+        conn.close()
+
+def select_merge_batch(stats, max_merges):
+    """
+    Given the stats of the chunks, return the next pairs to merge, up to max_merges:
+    the most common pair, followed by as many of the next most common pairs as can
+    be merged in the same pass while learning the same merges as one at a time
+    """
+    # the pairs by decreasing count, ties in order of first occurrence
+    # (the sort is stable, even in reverse)
+    order = sorted(stats, key=stats.__getitem__, reverse=True)
+    batch = [order[0]]
+    tokens = set(order[0])
+    for k in range(1, min(max_merges, len(order))):
+        # merging (t, t) makes pairs of two new tokens out of up to half of
+        # its own occurrences, which can outnumber the next pair
+        last_pair = batch[-1]
+        if last_pair[0] == last_pair[1]:
+            break
+        pair = order[k]
+        # a pair sharing a token with the batch loses occurrences to it, and
+        # since it was at least as common as the pairs after it, it cannot be skipped
+        if pair[0] in tokens or pair[1] in tokens:
+            break
+        # every pair made with the new tokens appears at most as often as the pair
+        # it replaces, which shares a token with the batch, so the pair is still
+        # the most common one only if it beats the most common of those
+        bound = next((stats[p] for p in islice(order, k + 1, None) if p[0] in tokens or p[1] in tokens), 0)
+        if stats[pair] <= bound:
+            break
+        batch.append(pair)
+        tokens.update(pair)
+    return batch
+
 class RegexTokenizer(Tokenizer):
 
     def __init__(self, pattern=None):
@@ -38,34 +107,64 @@ class RegexTokenizer(Tokenizer):
         # input text preprocessing
         ids = [list(ch.encode("utf-8")) for ch in text_chunks]
 
+        # on large texts, the chunks are counted and merged by worker processes,
+        # since no pair crosses two chunks the work splits along them
+        num_workers = os.cpu_count() or 1
+        workers = []
+        if ids and num_merges and num_workers > 1 and len(text) >= PARALLEL_TRAIN_MIN_CHARS:
+            workers = start_train_workers(ids, num_workers)
+            # the workers hold the chunks from now on, keeping them here as well
+            # would copy them, as the refcounts of the forked pages get updated
+            ids = None
+
         # iteratively merge the most common pairs to create new tokens
         merges = {} # (int, int) -> int
         vocab = {idx: bytes([idx]) for idx in range(256)} # idx -> bytes
-        for i in range(num_merges):
-            # count the number of times every consecutive pair appears
-            stats = {}
-            for chunk_ids in ids:
-                # passing in stats will update it in place, adding up counts,
-                # see the get_stats function in base.py
-                get_stats(chunk_ids, stats)
-            # find the pair with the highest count
-            pair = max(stats, key=stats.get)
-            # mint a new token: assign it the next available id
-            idx = 256 + i
-            # replace all occurrences of pair in ids with idx
-            ids = [merge(chunk_ids, pair, idx) for chunk_ids in ids]
-            # save the merge
-            merges[pair] = idx
-            vocab[idx] = vocab[pair[0]] + vocab[pair[1]]
-
-            # prints if the verbose flag is set
-            if verbose:
-                print(f"merge {i+1}/{num_merges}: {pair} -> {idx} ({vocab[idx]}) had {stats[pair]} occurrences")
+        try:
+            while len(merges) < num_merges:
+                # count the number of times every consecutive pair appears,
+                # in all the chunks at once, see the get_stats_all function in base.py
+                if workers:
+                    # add up the stats of the workers in the order of their shares,
+                    # so that the pairs are still in order of first occurrence
+                    stats = Counter()
+                    for process, conn in workers:
+                        stats.update(conn.recv())
+                else:
+                    stats = get_stats_all(ids)
+                if not stats:
+                    # nothing left to merge
+                    raise ValueError(f"the text only has pairs for {len(merges)} merges, not {num_merges}")
+                # find the pair with the highest count, along with the next ones
+                # that can be merged in the same pass, see select_merge_batch
+                batch = select_merge_batch(stats, num_merges - len(merges))
+                # mint new tokens: assign them the next available ids, in order
+                batch_merges = {pair: 256 + len(merges) + k for k, pair in enumerate(batch)}
+                # replace all occurrences of the pairs in ids with their idx
+                if workers:
+                    # no need for the workers to merge after the last merge
+                    if len(merges) + len(batch) < num_merges:
+                        for process, conn in workers:
+                            conn.send(batch_merges)
+                else:
+                    ids = [merge_batch(chunk_ids, batch_merges) for chunk_ids in ids]
+                for pair, idx in batch_merges.items():
+                    # save the merge
+                    merges[pair] = idx
+                    vocab[idx] = vocab[pair[0]] + vocab[pair[1]]
+
+                    # prints if the verbose flag is set
+                    if verbose:
+                        print(f"merge {idx-255}/{num_merges}: {pair} -> {idx} ({vocab[idx]}) had {stats[pair]} occurrences")
+        finally:
+            stop_train_workers(workers)
 
         # used in encode()
         self.merges = merges
         # used in decode()
         self.vocab = vocab
+        # the cached encodings were made with the old merges
+        self._encode_cache.clear()
 
     def register_special_tokens(self, special_tokens):
         # special_tokens is a dictionary of str -> int
@@ -76,9 +175,12 @@ class RegexTokenizer(Tokenizer):
     def decode(self, ids):
         # given ids (list of integers), return Python string
         part_bytes = []
+        # a single vocab lookup per id, instead of a membership check and a lookup
+        get = self.vocab.get
         for idx in ids:
-            if idx in self.vocab:
-                part_bytes.append(self.vocab[idx])
+            token = get(idx)
+            if token is not None:
+                part_bytes.append(token)
             elif idx in self.inverse_special_tokens:
                 part_bytes.append(self.inverse_special_tokens[idx].encode("utf-8"))
             else:
@@ -89,24 +191,27 @@ class RegexTokenizer(Tokenizer):
 
     def _encode_chunk(self, text_bytes):
         # return the token ids
+        # chunks are mostly words, which repeat a lot, so they are cached
+        # (as a tuple, a copy of which is returned, so that callers and
+        # subclasses can modify the returned list without changing the cache)
+        cached_ids = self._encode_cache.get(text_bytes)
+        if cached_ids is not None:
+            return list(cached_ids)
+
         # let's begin. first, convert all bytes to integers in range 0..255
         ids = list(text_bytes)
         while len(ids) >= 2:
             # find the pair with the lowest merge index
-            stats = get_stats(ids)
-            pair = min(stats, key=lambda p: self.merges.get(p, float("inf")))
-
-            # like in BasicTokenizer, if there are no more merges available,
-            # the key will result in an inf for every single pair, and the min
-            # will be just the first pair in the list, arbitrarily
-            # we can detect this terminating case by a membership check
-            if pair not in self.merges:
+            pair = find_best_merge(ids, self.merges)
+            if pair is None:
                 # nothing else can be merged anymore
                 break
 
             # otherwise let's merge the best pair (lowest merge index)
             idx = self.merges[pair]
             ids = merge(ids, pair, idx)
+
+        self._cache_encoding(text_bytes, tuple(ids))
         return ids
 
     def encode_ordinary(self, text):